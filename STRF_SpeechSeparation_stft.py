@@ -14,7 +14,6 @@ import jax
 import jax.numpy as jnp
 from jax import grad, jit, value_and_grad, vmap, config 
 from functools import partial
-config.update("jax_enable_x64", True)
 
 import optax
 import flax.linen as nn
@@ -86,11 +85,11 @@ loss{config.loss}_convFeats{config.conv_features}_batchSize{config.minibatch_siz
     eps = 1e-10
     for i in range(len(x)):
       temp = librosa.feature.melspectrogram(y=np.array(x[i,:]), sr=16000, n_fft=512, hop_length=80)[:,:200].T
-      temp = jnp.log(jnp.array(temp)+eps)
-      temp += -jnp.log(eps)
-      #temp = (temp-jnp.mean(temp))/jnp.var(temp)
       s.append(temp)
-    return jnp.stack(s)
+    s = jnp.log(jnp.asarray(np.stack(s))+eps) # one device transfer and log
+    s += -jnp.log(eps)
+    #s = (s-jnp.mean(s))/jnp.var(s)
+    return s
 
   def audspec_loss(s, s_hat, loss=config.loss):
     if loss == 'L2':
@@ -177,8 +176,7 @@ class audioSTRFAE(nn.Module):
     if self.input_type == 'audio':
       self.audspec = AuditorySpectrogram(input_length=16000)
     elif self.input_type == 'spec':
-      with np.load('cochlear_filter_params.npz') as data:
-        self.Bs, self.As = jnp.array(data['Bs']), jnp.array(data['As'])
+      self.Bs, self.As = read_cochba_j()
     else: raise KeyError
 
   def __call__(self, x, sr):
@@ -13,7 +13,6 @@ from torch.utils import data
 import jax
 import jax.numpy as jnp
 from jax import grad, jit, value_and_grad, vmap, config, random
-config.update("jax_enable_x64", True)
 
 import optax
 import flax.linen as nn
@@ -0,0 +1,44 @@
+import jax
+from jax import numpy as jnp
+
+
+def horner(coeffs, x):
+  '''
+  Evaluate the polynomials sum_i coeffs[..., i] * x**i with Horner's method.
+  Only one array the size of the output is live at a time. 
+
+  coeffs: ... x n_coeffs (n_coeffs > 1). x: n_points. Works on numpy and jax 
+  arrays. Output: ... x n_points
+  '''
+  acc = coeffs[..., -1:]
+  for i in range(coeffs.shape[-1]-2, -1, -1):
+    acc = acc*x + coeffs[..., i:i+1]
+  return acc
+
+
+def frame_leaky_integrator(x, alpha, L_frm):
+  '''
+  Apply the leaky integrator y[n] = x[n] + alpha*y[n-1] along the last axis 
+  of x, starting at rest, and keep only the last sample of every frame of 
+  L_frm samples, i.e. y[L_frm-1::L_frm]. b = [1], a = [1, -alpha]
+
+  Within a frame the output is a weighted sum of its samples plus the decayed
+  output of the previous frame, so the lax.scan runs over frames only and 
+  the full-length output is never materialized. 
+
+  x: ... x n_time_samples. Trailing samples that do not fill a frame are 
+  dropped. Output: ... x (n_time_samples // L_frm)
+  '''
+  N = x.shape[-1] // L_frm # number of frames
+  frames = x[..., :N*L_frm].reshape(x.shape[:-1] + (N, L_frm))
+  # each frame from rest; full float32 precision (no TF32/bf16 passes)
+  u = jnp.matmul(frames, alpha**jnp.arange(L_frm-1, -1, -1), 
+                 precision=jax.lax.Precision.HIGHEST)
+  decay = alpha**L_frm
+
+  def step(y, u_t):
+    y = decay*y + u_t
+    return y, y
+  _, y = jax.lax.scan(step, jnp.zeros(u.shape[:-1], dtype=u.dtype), 
+                      jnp.moveaxis(u, -1, 0))
+  return jnp.moveaxis(y, 0, -1)
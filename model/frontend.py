@@ -1,40 +1,36 @@
 import numpy as np 
 import jax
-jax.config.update("jax_enable_x64", True)
 from jax import numpy as jnp
 import flax.linen as nn
 from jax.scipy.signal import stft, istft
 
+from model.filters import frame_leaky_integrator, horner
+
 
 class CochlearFilter_Roex_fft(nn.Module):
   '''
   The filterbank used in Auditory Spectrogram (chi2005). 
 
-  Applies filtering through fft -> multiplying.
+  Applies filtering through rfft -> multiplying.
   '''
   input_length: int # Used to calculate filter duration
   sr: int = 16000  # Default sample rate
   
   def setup(self):
     with np.load('cochlear_filter_params.npz') as data:
-      Bs, As = jnp.array(data['Bs']), jnp.array(data['As'])
+      Bs, As = data['Bs'], data['As']
 
-    freqs = jnp.fft.fftfreq(self.input_length)*2*np.pi
-    e_jw = jnp.cos(freqs) - 1j*jnp.sin(freqs)
+    # Evaluated in float64 on the host, see strfpy_jax.precompute_H(). 
+    # Only the resulting filters are stored in complex64.
+    freqs = np.fft.rfftfreq(self.input_length)*2*np.pi
+    e_jw = np.cos(freqs) - 1j*np.sin(freqs)
 
-    self.Hs = jnp.zeros([As.shape[0], self.input_length], dtype=jnp.complex128)
-    for i in range(As.shape[0]):
-      b, a = Bs[i,:], As[i,:]
-      H = jnp.sum(jnp.array([b[i]*e_jw**i for i in range(25)]), axis=0) 
-      H /= jnp.sum(jnp.array([a[i]*e_jw**i for i in range(25)]), axis=0)
-      self.Hs = self.Hs.at[i, :].set(H)
+    self.Hs = jnp.asarray(horner(Bs, e_jw) / horner(As, e_jw), 
+                          dtype=jnp.complex64) # n_channels x input_length//2+1
     
   def __call__(self, x):
-    X = jnp.fft.fft(x)
-    cochleagram = []
-    for i in range(self.Hs.shape[0]):
-      cochleagram.append(jnp.fft.ifft(self.Hs[i,:]*X).real)
-    cochleagram = jnp.stack(cochleagram)
+    X = jnp.fft.rfft(x)
+    cochleagram = jnp.fft.irfft(self.Hs*X, n=self.input_length)
     #cochleagram = cochleagram.transpose(1,0,2)
     return cochleagram
   
@@ -43,12 +39,10 @@ class CochlearFilter_Roex_fft(nn.Module):
     Takes in a cochleagram and invert it.
     x: 129 x n_time_samples
     '''
-    out = []
-    for i in range(self.Hs.shape[0]):
-      X = jnp.fft.fft(x[i,:])
-      out.append(jnp.fft.ifft(X/self.Hs[i,:]).real)
+    X = jnp.fft.rfft(x)
+    out = jnp.fft.irfft(X/self.Hs, n=x.shape[-1])
     #print(out.shape)
-    return jnp.mean(jnp.stack(out), axis=0).real
+    return jnp.mean(out, axis=0)
   
 vCochlearFilter_Roex_fft = nn.vmap(
 CochlearFilter_Roex_fft,
@@ -80,11 +74,7 @@ class PowerLawCompression(nn.Module):
 
   def __call__(self, x):
     if len(x.shape) == 2: # H x W
-      for i in range(x.shape[0]):
-        x = x.at[i,:].set(
-          jnp.abs(x[i,:]) ** self.alpha.value[i] * jnp.sign(x[i,:])
-        )
-
+      x = jnp.abs(x) ** self.alpha.value[:, None] * jnp.sign(x)
 
       #x = self.compression(x.T).T
     else: # B x H x W
@@ -99,12 +89,12 @@ class LateralInhibitionNetwork(nn.Module):
   Applies LIN, which is composed of linear convolution (along freq.) and ReLU.
   '''
   def setup(self):
-    def initializer_first_diff(key, shape, dtype=jnp.float64):
-      kernel = jnp.array([1, -1], dtype=jnp.float64)
+    def initializer_first_diff(key, shape, dtype=jnp.float32):
+      kernel = jnp.array([1, -1], dtype=dtype)
       return kernel.reshape(shape)
     self.LI_conv = nn.Conv(features=1, kernel_size=(2,), strides=(1,),
                            kernel_init=initializer_first_diff,
-                           dtype=jnp.float64, use_bias=False)
+                           dtype=jnp.float32, use_bias=False)
 
 
   def __call__(self, x):
@@ -127,8 +117,10 @@ class LateralInhibitionNetwork(nn.Module):
   
 class LeakyIntegration(nn.Module):
   '''
-  Applies leaky integration followed by downsampling.
-  Leaky integrator was implemented by filtering in the FFT domain.
+  Applies leaky integration followed by downsampling, with 
+  frame_leaky_integrator(): y[n] = x[n] + alpha*y[n-1] integrates from rest, 
+  like lfilter, keeping the last sample of every frame of downsample_rate 
+  samples.
   This version is not vectorized. Use the vmap version for batch handling.
 
   alpha is a learable parameter. 
@@ -138,23 +130,10 @@ class LeakyIntegration(nn.Module):
 
   def setup(self):
     self.alpha = self.variable("params", "alpha", lambda: jnp.array(0.9922179))
-    self.freqs = jnp.fft.fftfreq(self.input_length) * 2 * jnp.pi
 
   @nn.compact
   def __call__(self, x):
-    out = []
-    for i in range(x.shape[0]):
-      X = jnp.fft.fft(x[i,:])
-      H = 1 / (1 - self.alpha.value * 
-               (jnp.cos(self.freqs) - 1j*jnp.sin(self.freqs))
-               )
-      out.append(jnp.fft.ifft(H * X).real)
-    out = jnp.stack(out)
-
-    # Downsample
-    
-    out = out[:, (self.downsample_rate - 1)::self.downsample_rate]
-    return out
+    return frame_leaky_integrator(x, self.alpha.value, self.downsample_rate)
   
 vLeakyIntegration = nn.vmap(
 LeakyIntegration,
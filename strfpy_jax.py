@@ -2,24 +2,34 @@ import librosa
 from tqdm import tqdm
 import pickle
 import glob
+import os
 import time
+import warnings
 import numpy as np
 
 import jax
 import jax.numpy as jnp
-from jax import grad, jit, value_and_grad
+from jax import grad, jit, lax, value_and_grad, vmap
 from jax.scipy.signal import convolve as jconvolve 
-from jax import config
-config.update("jax_enable_x64", True)
 
-from functools import partial
+from functools import lru_cache, partial
 
 from math import ceil,floor
 from scipy.signal import lfilter
 from strfpy import *
+from model.filters import frame_leaky_integrator, horner
+
+COCHBA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                           'model', 'cochlear_filter_params.npz')
 
-def read_cochba_j():
-    with open('./cochba.txt') as f:
+def cochba_txt_to_npz(txt_filename, filename):
+    '''
+    One-off conversion of the NSL cochba.txt table into an .npz holding the 
+    filter coefficients Bs, As (n_channels x 25, zero-padded), so that 
+    read_cochba_j() does not parse text. filename has no default, so the 
+    shipped COCHBA_FILE is only overwritten when passed explicitly.
+    '''
+    with open(txt_filename) as f:
         file = f.readlines()
     cochba = []
     for line in file:
@@ -30,22 +40,54 @@ def read_cochba_j():
             num = num.replace("i","j")
             num = num.replace(" ","")
             cochba[-1].append(complex(num))
-    cochba = jnp.array(cochba)
+    cochba = np.array(cochba)
     Bs, As = [], []
     ps = [p.real for p in list(cochba[0, :])] # beware of 0-indexing!
     for ch, p in enumerate(ps):
-        temp = cochba[1:p.astype(int)+2,ch]
-        B, A = jnp.array([f.real for f in temp]), jnp.array([f.imag for f in temp])
-        B = jnp.pad(B, (0, 25-len(temp)), mode='constant')
-        A = jnp.pad(A, (0, 25-len(temp)), mode='constant')
-        Bs.append(B)
-        As.append(A)  
-    Bs = jnp.array(np.vstack(Bs))
-    As = jnp.array(np.vstack(As))
-    return Bs, As 
-Bs, As = read_cochba_j()
-
-def sigmoid_j(y, fac):
+        temp = cochba[1:int(p)+2,ch]
+        Bs.append(np.pad(temp.real, (0, 25-len(temp)), mode='constant'))
+        As.append(np.pad(temp.imag, (0, 25-len(temp)), mode='constant'))
+    np.savez(filename, Bs=np.vstack(Bs), As=np.vstack(As))
+
+@lru_cache(maxsize=None)
+def read_cochba_j(filename=COCHBA_FILE):
+    '''
+    Cochlear filter coefficients Bs, As (n_channels x 25), as written by 
+    cochba_txt_to_npz(). Loaded once, cached and returned as read-only 
+    float64 numpy arrays (see precompute_H()).
+    '''
+    with np.load(filename) as data:
+        Bs, As = data['Bs'], data['As']
+    Bs.flags.writeable, As.flags.writeable = False, False
+    return Bs, As
+
+SIGMOID_MODES = {
+    'sigmoid': lambda y, fac: 1/(1+jnp.exp(-y/fac)),
+    'hardlimit': lambda y, fac: (y > 0).astype(y.dtype),
+    'halfwave': lambda y, fac: jnp.maximum(y, 0),
+    'linear': lambda y, fac: y,
+}
+
+def sigmoid_mode(fac):
+    '''
+    Mode of sigmoid_j() for a concrete nonlinear factor fac, following the 
+    MATLAB convention below.
+    '''
+    if fac > 0: 
+        return 'sigmoid'
+    elif fac == 0:
+        return 'hardlimit'
+    elif fac == -1:
+        return 'halfwave'
+    elif fac == -3:
+        raise NotImplementedError # halfregu()
+    return 'linear'
+
+@partial(jit, static_argnames='mode')
+def _sigmoid_j(y, fac, mode):
+    return SIGMOID_MODES[mode](y, fac)
+
+def sigmoid_j(y, fac, mode=None):
     '''
     Copied from MATLAB documentation: nonlinear function for cochlear model.
     
@@ -54,51 +96,158 @@ def sigmoid_j(y, fac):
     	 -- fac = 0, hard-limiter
     	 -- fac = -1, half-wave rectifier
     	 -- else, no operation, i.e., linear 
+    mode: one of SIGMOID_MODES, 'sigmoid', 'hardlimit', 'halfwave' or 
+    'linear'. If None, it is derived from fac, which then has to be concrete. 
+    With an explicit mode fac may be traced (e.g. learned), and the function 
+    compiles once per mode rather than once per value of fac.
 
     SIGMOID is a monotonic increasing function which simulates 
     hair cell nonlinearity. 
     '''
-    if fac > 0: 
-        y = jnp.exp(-y/fac)
-        y = 1/(1+y)
-    elif fac == 0:
-        y = (y > 0) # Do I need to turn this into integer?
-    elif fac == -3:
-        raise NotImplementedError # halfregu()
-    return y
+    if mode is None:
+        mode = sigmoid_mode(fac)
+    return _sigmoid_j(y, fac, mode)
 
-@jit
-def cochlear_filter_fft(b, a, x):
+@lru_cache(maxsize=32)
+def e_jw_rfft(N):
     '''
-    Given cochlear filter coefficients b and a, apply the filter on signal x by 
-    multiplying the transfer function in the fft domain (followed by ifft). 
+    e^{-jw} on the N-point rfft grid, cached per N. Kept as a read-only 
+    complex128 numpy array, so it is a constant of any jitted caller.
+    '''
+    e_jw = np.exp(-1j*np.fft.rfftfreq(N)*2*np.pi)
+    e_jw.flags.writeable = False
+    return e_jw
 
-    Modified from recursive_iir_jax for a and b strictly of duration 25.
-    Assume that the initial condition is rest.
+def concrete_coeffs(Bs, As):
+    '''
+    Bs, As as float64 numpy arrays for precompute_H(). They must be concrete 
+    (e.g. closed over by the jitted function), not jit arguments.
+    '''
+    if isinstance(Bs, jax.core.Tracer) or isinstance(As, jax.core.Tracer):
+        raise TypeError('Bs and As must be concrete arrays, not traced; close '
+                        'over them instead of passing them as jit arguments')
+    return np.asarray(Bs, dtype=np.float64), np.asarray(As, dtype=np.float64)
+
+def precompute_H(Bs, As, N):
+    '''
+    Transfer functions H(e^jw) = B(e^jw) / A(e^jw) of all cochlear filters on 
+    the N-point rfft grid, evaluated with Horner's method. The signals are 
+    real, so the negative frequencies are never needed.
+    Always evaluated in float64 with numpy: in float32 the 24th-order 
+    polynomials give non-finite H and errors of up to ~200%. 
     
-    x: length * dimensions. If the second dimension exists, the same filter 
-    would be applied along each dimension.
+    Bs, As: n_channels x 25 filter coefficients, concrete.
+    Output: n_channels x (N//2+1), complex128 numpy array. Use cochlear_H() 
+    for a cached jax array in the working precision.
     '''
-    assert len(b) == 25
-    assert len(a) == 25
+    Bs, As = concrete_coeffs(Bs, As)
+    assert Bs.shape[1] == 25
+    assert As.shape[1] == 25
 
-    freqs = jnp.fft.fftfreq(len(x))*2*np.pi
-    e_jw = jnp.cos(freqs) - 1j*jnp.sin(freqs)
-    H = jnp.sum(jnp.array([b[i]*e_jw**i for i in range(25)]), axis=0) 
-    H /= jnp.sum(jnp.array([a[i]*e_jw**i for i in range(25)]), axis=0)
+    e_jw = e_jw_rfft(N)
+    return horner(Bs, e_jw) / horner(As, e_jw)
 
-    X = jnp.fft.fft(x)
-    X = jnp.fft.ifft(H*X)
+@lru_cache(maxsize=32)
+def _cached_H(N, dtype, Bs, As):
+    Bs, As = np.frombuffer(Bs).reshape(-1, 25), np.frombuffer(As).reshape(-1, 25)
+    with jax.ensure_compile_time_eval():
+        return jnp.asarray(precompute_H(Bs, As, N), dtype=dtype)
+
+def cochlear_H(Bs, As, N, dtype=jnp.complex64):
+    '''
+    Cached version of precompute_H(). Bs, As and the signal length are fixed 
+    across a training run, so H is computed once per N and reused, including 
+    inside jit where it becomes a constant of the compiled function. 
+    H is cast to dtype. The cache keeps the 32 most recently used 
+    (N, dtype, Bs, As).
+    Bs and As must be concrete, see concrete_coeffs().
+    '''
+    Bs, As = concrete_coeffs(Bs, As)
+    return _cached_H(N, jnp.dtype(dtype), Bs.tobytes(), As.tobytes())
+
+@jit
+def cochlear_filter_fft(H, x):
+    '''
+    Apply the cochlear filter(s) with transfer function H on real signal x by 
+    multiplying in the rfft domain (followed by irfft). 
+    Assume that the initial condition is rest.
+    
+    H: transfer function(s) from cochlear_H(), N//2+1 or n_channels x N//2+1.
+    x: signal of length N. With n_channels x N//2+1 H, all channels are 
+    filtered at once.
+    '''
+    X = jnp.fft.rfft(x)
+    X = jnp.fft.irfft(H*X, n=x.shape[-1])
     #X = jnp.abs(X)
     return X
 
+IR_LEN = 6144 # samples of the cochlear impulse responses kept for overlap-save
+@lru_cache(maxsize=32)
+def _cached_H_block(ir_len, n_fft, dtype, Bs, As):
+    Bs, As = np.frombuffer(Bs).reshape(-1, 25), np.frombuffer(As).reshape(-1, 25)
+    n_grid = max(2**16, 2*n_fft)
+    h = np.fft.irfft(precompute_H(Bs, As, n_grid), n=n_grid)
+    H = np.fft.rfft(h[:, :ir_len], n=n_fft)
+    with jax.ensure_compile_time_eval():
+        return jnp.asarray(H, dtype=dtype)
+
+def cochlear_H_block(Bs, As, ir_len=IR_LEN, n_fft=16384, dtype=jnp.complex64):
+    '''
+    Cochlear filters truncated to FIR for cochlear_filter_ols(): the first 
+    ir_len samples of each impulse response, zero-padded to n_fft and 
+    transformed with rfft. The impulse responses are read off a 2^16-point 
+    grid, long enough for the circular aliasing of the IIR tails to be 
+    negligible. Computed with precompute_H() and cached, as cochlear_H().
+
+    With the default IR_LEN, less than 1e-7 of the impulse response energy 
+    of any channel is dropped. n_fft must exceed ir_len; each block yields 
+    only n_fft-ir_len+1 new samples, so larger blocks waste less (the overlap 
+    is 37% of a 16384-point FFT, 9% of a 65536-point one).
+    Output: n_channels x (n_fft//2+1), complex.
+    '''
+    if n_fft <= ir_len:
+        raise ValueError(f'n_fft ({n_fft}) must be larger than ir_len ({ir_len})')
+    Bs, As = concrete_coeffs(Bs, As)
+    return _cached_H_block(ir_len, n_fft, jnp.dtype(dtype), 
+                           Bs.tobytes(), As.tobytes())
+
+@partial(jit, static_argnums=(2, 3))
+def cochlear_filter_ols(H, x, n_fft, ir_len=IR_LEN):
+    '''
+    Apply the cochlear filters on a long real signal x by overlap-save: x is 
+    cut into overlapping blocks of n_fft samples, each block is filtered in the 
+    rfft domain and its first ir_len-1 (circularly aliased) samples are 
+    discarded. A lax.scan over blocks keeps each FFT small and cache-resident 
+    instead of transforming the whole signal at once. 
+    Unlike cochlear_filter_fft() this is a linear (not circular) convolution, 
+    i.e. the filters start at rest as in lfilter.
+
+    H: n_channels x (n_fft//2+1) from cochlear_H_block() with the same n_fft 
+    and ir_len. n_fft is passed explicitly, as odd and even n_fft give the 
+    same H.shape.
+    x: signal of length N. Output: n_channels x N
+    '''
+    if H.shape[-1] != n_fft//2+1:
+        raise ValueError(f'H has {H.shape[-1]} frequencies, expected '
+                         f'{n_fft//2+1} for n_fft={n_fft}')
+    hop = n_fft - ir_len + 1 # new output samples per block
+    N = len(x)
+    n_blocks = ceil(N/hop)
+    x = jnp.pad(x, (ir_len-1, n_blocks*hop-N), mode='constant')
+
+    def block(_, start):
+        X = jnp.fft.rfft(lax.dynamic_slice(x, (start,), (n_fft,)))
+        return None, jnp.fft.irfft(H*X, n=n_fft)[:, ir_len-1:]
+    _, y = lax.scan(block, None, jnp.arange(n_blocks)*hop) # n_blocks x C x hop
+    return jnp.moveaxis(y, 0, 1).reshape(H.shape[0], n_blocks*hop)[:, :N]
+
 @jit
 def cochlear_filter(b, a, x):
     '''
     Given cochlear filter coefficients b and a, apply the filter on signal x by 
     recursive computation using ARMA in the time domain. 
-    When gradients are taken, this could be extremely slow due to how jax handles
-    for-loops and the fact that for-loop is large in time domain. 
+    The recursion is a lax.scan over time carrying the last 24 outputs, so it
+    traces once regardless of the signal length. 
 
     Modified from recursive_iir_jax for a and b strictly of duration 25.
     Assume that the initial condition is rest.
@@ -109,34 +258,51 @@ def cochlear_filter(b, a, x):
     assert len(a) == 25
     
     a1 = a[1:]
-    ar = jconvolve(x, b) # AR part
-    y = jnp.zeros(len(x)+24)
-    
-    for i in range(len(x)):
-        t0 = time.time()
-        if len(a) > 1:
-            ma = jnp.sum(y[i:i+24] * a1[::-1])
-        else:
-            ma = 0
-        y = y.at[i+24].set(ar[i] - ma)
-    return y[24:]
+    ar = jconvolve(x, b)[:len(x)] # AR part
+
+    def step(y_past, ar_i): # y_past: y[n-24], ..., y[n-1]
+        ma = jnp.dot(y_past, a1[::-1])
+        y_i = ar_i - ma
+        return jnp.concatenate([y_past[1:], y_i[None]]), y_i
+    _, y = lax.scan(step, jnp.zeros(24, dtype=ar.dtype), ar)
+    return y
 
 @jit
 def leaky_integrator_fft(x, alpha):
     ''' 
-    Apply the leaky integrator by filtering in fft domain. 
+    Apply the leaky integrator on real x by filtering in rfft domain. 
     Would this be faster if it were a convolution? 
     b = [1], a = [1, -alpha] '''
     #alpha = 0.98
-    X = jnp.fft.fft(x)
-    freqs = jnp.fft.fftfreq(len(x))*2*np.pi
-    H = 1 / (1 - alpha * (jnp.cos(freqs) - 1j*jnp.sin(freqs)))
-    return jnp.fft.ifft(H*X)
+    X = jnp.fft.rfft(x)
+    H = 1 / (1 - alpha * jnp.asarray(e_jw_rfft(len(x)), dtype=X.dtype))
+    return jnp.fft.irfft(H*X, n=len(x))
+
+@partial(jit, static_argnums=2)
+def leaky_integrator(x, alpha, L_frm=1):
+    '''
+    Jitted frame_leaky_integrator(): leaky integration from rest along the 
+    last axis of x, keeping y[L_frm-1::L_frm]. b = [1], a = [1, -alpha]
+
+    x: ... x n_time_samples. Output: ... x (n_time_samples // L_frm)
+    '''
+    return frame_leaky_integrator(x, alpha, L_frm)
+
+@partial(jit, static_argnums=2)
+def lin_leaky_integrator(v, alpha, L_frm=1):
+    '''
+    Stages y3 -> y5 of wav2aud_j() in one jitted function: first difference 
+    across channels, half-wave rectifier, then leaky_integrator(). XLA fuses 
+    the elementwise steps into the integrator's input, so the intermediate 
+    n_channels x N arrays y3 and y4 are never written out.
 
+    v: n_channels x N. Output: (n_channels-1) x (N // L_frm)
+    '''
+    return leaky_integrator(jnp.maximum(v[:-1, :] - v[1:, :], 0), alpha, L_frm)
     
 def wav2aud_j(x, frmlen, time_constant, fac, octave_shift, 
               As, Bs, filt_type='p', compression_method='identity',
-              fft=True, return_stage=5, downsample='default'):
+              fft=True, return_stage=5, precision=None, block_size=None):
     '''
     Leslie: implementation of matlab wav2aud2.m in Ding et al., 2017
     
@@ -152,8 +318,31 @@ def wav2aud_j(x, frmlen, time_constant, fac, octave_shift,
     octave_shift: shifted by # of octave, e.g. 0 for 16k, -1 for 8k.
     sf = 16k * 2^[octave_shift]
     filt_type: filter type. Currently only implemented 'p', Powen's IIR filter
+    precision: 'float32' (complex64 in the fft domain) or 'float64', which 
+    requires jax_enable_x64, e.g. for gradient checks. Default (None): 
+    'float32' with fft=True; with fft=False 'float64' if jax_enable_x64 is on.
+    fft: filter in the fft domain (default) or by the time-domain recursion. 
+    The 24th-order recursion is ill-conditioned in float32 (errors of several 
+    percent against lfilter), so fft=False in float32 warns.
+    block_size: if given (fft=True), filter by overlap-save with FFTs of this 
+    many samples instead of one FFT of the whole signal; for long audio. 
+    Must be larger than IR_LEN (6144); the first IR_LEN-1 samples of every 
+    block are overlap, 37% of a 16384-point block.
+
+    The leaky integrator (y5) integrates from rest, like lfilter, and keeps 
+    the last sample of every frame.
     '''    
     assert As.shape == Bs.shape
+    if precision is None:
+        precision = 'float64' if not fft and jax.config.jax_enable_x64 \
+            else 'float32'
+    dtype = jnp.dtype(precision)
+    if not fft and dtype == jnp.float32:
+        warnings.warn('fft=False in float32 is off by several percent; enable '
+                      "jax_enable_x64 and use precision='float64'")
+    if dtype == jnp.float64 and not jax.config.jax_enable_x64:
+        raise ValueError("precision='float64' requires jax_enable_x64")
+    x = jnp.asarray(x, dtype=dtype)
     
     if filt_type != 'p': raise NotImplementedError
     L_frm = round(frmlen * 2**(4+octave_shift)) # frame length (points)
@@ -165,46 +354,72 @@ def wav2aud_j(x, frmlen, time_constant, fac, octave_shift,
     else:
         alpha = 0
 
-    v5 = []
-    for ch in range(len(As)):
-        B, A = Bs[ch,:], As[ch,:]
-        if fft:
-            y = cochlear_filter_fft(B, A, x) # -> y1
-        else:
-            y = cochlear_filter(B, A, x) # -> y1
-        #y = sigmoid_j(y, fac) # -> y2
-        # Useless for now, since fac=-2, leading to linear operation
-        v5.append(y)
-    v5 = jnp.vstack(v5)
+    # One filter per channel, all channels applied to the same x -> y1
+    ctype = jnp.result_type(dtype, jnp.complex64)
+    if fft and block_size is not None:
+        if block_size <= IR_LEN:
+            raise ValueError(f'block_size ({block_size}) must be larger than '
+                             f'IR_LEN ({IR_LEN}), e.g. 16384')
+        v5 = cochlear_filter_ols(cochlear_H_block(Bs, As, n_fft=block_size, 
+                                                  dtype=ctype), x, block_size)
+    elif fft:
+        v5 = cochlear_filter_fft(cochlear_H(Bs, As, len(x), ctype), x)
+    else:
+        v5 = vmap(cochlear_filter, in_axes=(0, 0, None))(
+            jnp.asarray(Bs, dtype=dtype), jnp.asarray(As, dtype=dtype), x)
+    #v5 = sigmoid_j(v5, fac) # -> y2
+    # Useless for now, since fac=-2, leading to linear operation
     if return_stage==1:return v5
     v5 = compression(v5, fac, method=compression_method)
     if return_stage==2: return v5
+    if return_stage==5 and time_constant != 0: # y3 -> y5 fused
+        return lin_leaky_integrator(v5, alpha, L_frm)
     
     # Apply a first difference filter -> y3
     v5 = v5[:-1, :] - v5[1:, :]
     if return_stage==3: return v5
     
     # Half wave rectifier -> y4
-    v5 = v5.at[:,:].max(0)
+    v5 = jnp.maximum(v5, 0)
     if return_stage==4: return v5
     
     if time_constant != 0: # leaky integration -> y5        
-        out = []
-        for i in range(len(v5)):
-            out.append(leaky_integrator_fft(v5[i,:], alpha)) # This can be vectorized
-        v5 = jnp.vstack(out)
-        v5 = v5.real
-        if downsample=='default':
-            inds = jnp.arange(1, N+1)*L_frm-1
-            v5 = v5[:,inds]
-        else:
-            v5 = v5[:, (L_frm - 1)::L_frm]
+        # keeps inds = jnp.arange(1, N+1)*L_frm-1 of the integrated signal
+        v5 = leaky_integrator(v5, alpha, L_frm)
     elif L_frm == 1: 
         pass
     else:
         raise NotImplementedError
     if return_stage==5: return v5
 
+def make_wav2aud_batch(frmlen, time_constant, fac, octave_shift, As, Bs, 
+                       **kwargs):
+    '''
+    Returns wav2aud_batch(xs), which applies wav2aud_j() with these parameters 
+    to a batch of waveforms xs (B x T). The batch is split across the local 
+    devices with pmap, and vmapped within each device. Build it once and 
+    reuse it, so that it is compiled only once per input shape.
+
+    On CPU, vmap only vectorizes within one core. JAX exposes the cores as 
+    separate devices only if XLA_FLAGS=--xla_force_host_platform_device_count=N
+    (or JAX_NUM_CPU_DEVICES=N) is set before jax is first imported, e.g. 
+    at the top of the training script.
+
+    If B is not a multiple of the number of devices, the batch is zero-padded 
+    and the padding dropped from the output.
+    Output: B x n_channels-1 x n_frames (as wav2aud_j with return_stage=5)
+    '''
+    n_dev = jax.local_device_count()
+    f = jax.pmap(vmap(lambda x: wav2aud_j(x, frmlen, time_constant, fac, 
+                                          octave_shift, As, Bs, **kwargs)))
+
+    def wav2aud_batch(xs):
+        B = xs.shape[0]
+        xs = jnp.pad(xs, ((0, -B % n_dev), (0, 0)))
+        out = f(xs.reshape((n_dev, -1) + xs.shape[1:]))
+        return out.reshape((-1,) + out.shape[2:])[:B]
+    return wav2aud_batch
+
 def cochleagram2aud(v5, frmlen, time_constant, fac, octave_shift, 
                     compression_method='identity'):
     '''
@@ -236,17 +451,12 @@ def cochleagram2aud(v5, frmlen, time_constant, fac, octave_shift,
     #v5 = v5[:-1, :] - v5[1:, :]
     
     # Half wave rectifier -> y4
-    v5 = v5.at[:,:].max(0)
+    v5 = jnp.maximum(v5, 0)
     
     if time_constant != 0: # leaky integration -> y5        
-        out = []
-        for i in range(len(v5)):
-            out.append(leaky_integrator_fft(v5[i,:], alpha)) # This can be vectorized
-        v5 = jnp.vstack(out)
-        v5 = v5.real
         # inds = jnp.arange(1, N+1)*L_frm-1
         # v5 = v5[:,inds]
-        v5 = v5[:, (L_frm - 1)::L_frm]
+        v5 = leaky_integrator(v5, alpha, L_frm)
     elif L_frm == 1: 
         pass
     else:
@@ -254,7 +464,7 @@ def cochleagram2aud(v5, frmlen, time_constant, fac, octave_shift,
     return v5
 
 def root_norm(x, p):
-    norm_constant = jnp.sum(x**p)/len(x)
+    norm_constant = jnp.sum(x**p, axis=-1, keepdims=True)/x.shape[-1]
     return (x/norm_constant)**(1/p)
 
 def power_norm(x, alpha):
@@ -271,17 +481,15 @@ def compression(mag, fac, method='identity'):
         y = mag
 
     #print(y.shape)
+    if method in ('logistic', 'root', 'power'):
+        fac = jnp.reshape(jnp.asarray(fac), (-1, 1)) # one value per channel
     if method=='logistic':
-        for i in range(y.shape[0]):
-            y = y.at[i,:].set(1/(1+jnp.exp(y[i,:]/fac[i])))
+        y = 1/(1+jnp.exp(y/fac))
     elif method == 'root':
-        for i in range(y.shape[0]):
-            # norm_factor = jnp.sum(y[i,:]**fac[i])**(1/fac[i])
-            # y = y.at[i,:].set(y[i,:]/norm_factor)
-            y = y.at[i,:].set(root_norm(y[i,:], p=fac[i]))
+        # norm_factor = jnp.sum(y**fac, axis=1)**(1/fac)
+        y = root_norm(y, p=fac)
     elif method == 'power':
-        for i in range(y.shape[0]):
-            y = y.at[i,:].set(power_norm(y[i,:], alpha=fac[i]))
+        y = power_norm(y, alpha=fac)
     elif method == 'identity':
         pass
     else:
@@ -289,29 +497,78 @@ def compression(mag, fac, method='identity'):
     return y
 
 
-def inverse_cochlear_filter(Bs, As, v):
+@jit
+def inverse_cochlear_filter_fft(H, v):
     '''
-    v: cochleagram of shape (n_channels, n_time_samples)
+    Undo cochlear filter(s) with transfer function H on real v by dividing by 
+    H in the rfft domain (followed by irfft). H from cochlear_H(); shapes as 
+    in cochlear_filter_fft().
+    The imaginary part of a complex v (e.g. return_stage=1 output of earlier, 
+    complex-valued versions of wav2aud_j()) is dropped.
     '''
-    xs = []
-    for ch in range(len(As)):
-        b, a = Bs[ch,:], As[ch,:]
+    V = jnp.fft.rfft(jnp.real(v))
+    return jnp.fft.irfft(V/H, n=v.shape[-1])
 
-        freqs = jnp.fft.fftfreq(v.shape[1])*2*np.pi
-        e_jw = jnp.cos(freqs) - 1j*jnp.sin(freqs)
-        H = jnp.sum(jnp.array([b[i]*e_jw**i for i in range(25)]), axis=0) 
-        H /= jnp.sum(jnp.array([a[i]*e_jw**i for i in range(25)]), axis=0)
-        V = jnp.fft.fft(v[ch, :])
-        V = jnp.fft.ifft(V/H)
-        xs.append(V)
-    xs = jnp.vstack(xs)
-    xs = jnp.mean(xs, axis=0)
-    return xs.real
+def inverse_cochlear_filter(Bs, As, v):
+    '''
+    v: cochleagram of shape (n_channels, n_time_samples), real (the imaginary 
+    part of a complex v is dropped)
+    '''
+    v = jnp.real(v)
+    H = cochlear_H(Bs, As, v.shape[1], jnp.result_type(v.dtype, jnp.complex64))
+    xs = inverse_cochlear_filter_fft(H, v)
+    return jnp.mean(xs, axis=0)
 
 ###################################
 ##### Cortical models (STRFs) #####
 
-#@jit
+def build_cortical_banks(rv, sv, N1, M1, STF, SRF, BP=0):
+    '''
+    Rate and scale filter banks of aud2cor_j(). 
+
+    rv, sv: rate and scale vectors (arrays). N1, M1: filter lengths.
+    Output: 
+    HR: 2K1 x 2N1 rate filters, row rdx+(sgn==1)*K1 for rate rv[rdx] and 
+        direction sgn
+    HS: K2 x M1 scale filters
+    '''
+    K1, K2 = len(rv), len(sv)
+    # Scale filters do not depend on the rate; build all K2 of them at once
+    PASS_s = [jnp.arange(K2)+BP+1, jnp.full(K2, K2+BP*2)] # Note zero indexing
+    HS = vmap(gen_corf_j, in_axes=(0, None, None, 0))(sv, M1, SRF, PASS_s)
+
+    # Rate filters, all K1 at once; PASS is unused by gen_cort_j
+    HR = vmap(lambda fc: gen_cort_j(fc, N1, STF, None))(rv)
+    zeros = jnp.zeros_like(HR)
+    # sgn = -1: conjugate mirror of the zero-padded filter, [H_0, 0, ..., 0, 
+    # |H_{N1-1}|, conj(H_{N1-1}), ..., conj(H_1)], built in one concatenate
+    HR_c = jnp.concatenate([HR[:, :1], zeros[:, 1:], jnp.abs(HR[:, -1:]), 
+                            jnp.conj(HR[:, :0:-1])], axis=1)
+    HR = jnp.concatenate([HR, zeros], axis=1) # sgn = 1, K1 x N2
+    HR = jnp.concatenate([HR_c, HR]) # index rdx+(sgn==1)*K1, 2K1 x N2
+
+    return HR, HS
+
+@lru_cache(maxsize=32)
+def _cached_cortical_banks(rv, sv, N1, M1, STF, SRF, BP):
+    with jax.ensure_compile_time_eval():
+        return build_cortical_banks(jnp.asarray(rv), jnp.asarray(sv), 
+                                    N1, M1, STF, SRF, BP)
+
+def cortical_banks(rv, sv, N1, M1, STF, SRF, BP=0):
+    '''
+    Cached version of build_cortical_banks(). rv and sv are fixed across a run,
+    so the banks are built once per (rv, sv, N1, M1, ...) and reused, including 
+    inside jit where they become constants of the compiled function. 
+    Falls back to build_cortical_banks() if rv or sv are traced.
+    '''
+    if isinstance(rv, jax.core.Tracer) or isinstance(sv, jax.core.Tracer):
+        return build_cortical_banks(jnp.asarray(rv), jnp.asarray(sv), 
+                                    N1, M1, STF, SRF, BP)
+    rv = tuple(np.asarray(rv, dtype=float).ravel().tolist())
+    sv = tuple(np.asarray(sv, dtype=float).ravel().tolist())
+    return _cached_cortical_banks(rv, sv, N1, M1, STF, SRF, BP)
+
 def aud2cor_j(y, paras, rv, sv):
     '''
     Python version of aud2cor() in the NSL toolbox. From auditory spectrogram to cortical STRF.
@@ -323,6 +580,9 @@ def aud2cor_j(y, paras, rv, sv):
     sv: scale vector
     out_filename: write the output in this file
     disp: normalization during display
+
+    Shapes and the (cached) filter banks are resolved here in Python; the 
+    filtering itself runs as one jitted function, aud2cor_banks_j().
     '''
     
     if len(paras) < 5: 
@@ -331,46 +591,39 @@ def aud2cor_j(y, paras, rv, sv):
     else:
         raise NotImplementedError
     
-    K1, K2 = len(rv), len(sv)
     N, M = y.shape
     # Parsing paras
     STF = 1000/paras[0]
     if M == 95: SRF = 20
     else: SRF = 24 # Why??
 
-    dM, dN = 0, 0
     N1, M1 = 2**ceil(np.log2(N)), 2**ceil(np.log2(M))
-    N2, M2 = N1*2, M1*2
+    HR, HS = cortical_banks(rv, sv, N1, M1, STF, SRF, BP)
+    return aud2cor_banks_j(y, HR, HS)
+
+@jit
+def aud2cor_banks_j(y, HR, HS):
+    '''
+    Filtering step of aud2cor_j(), given the filter banks from cortical_banks().
+
+    y: auditory spectrogram, N x M
+    HR: 2K1 x N2 rate filters; HS: K2 x M1 scale filters
+    Output: K2 x 2K1 x N x M, complex
+    '''
+    N, M = y.shape
+    N2, M1 = HR.shape[1], HS.shape[1]
+    M2 = M1*2
+    dM, dN = 0, 0
     
-    Y = jnp.fft.fft(y, M2, axis=1)[:,:M1] # Fourier transform (frequency)
+    Y = jnp.fft.rfft(y, M2, axis=1)[:,:M1] # Fourier transform (frequency)
     Y = jnp.fft.fft(Y[:N,:], N2, axis=0) # Fourier transform (temporal)
 
-    cr = jnp.zeros([K2, K1*2, N+2*dN, M+2*dM],dtype=complex)
-    for rdx in range(K1): # rate filtering
-        HR = gen_cort_j(rv[rdx], N1, STF, [rdx+1+BP, K1+BP*2])
-
-        for sgn in [1, -1]:
-            if sgn == 1: 
-                HR = jnp.concatenate([HR, np.zeros(N1)])
-            else: # conjugate
-                HR = jnp.insert(jnp.conj(jnp.flipud(HR[1:N2])), 0, HR[0])
-                HR = HR.at[N1].set(jnp.abs(HR[N1+1]))
-                #HR[N1] = jnp.abs(HR[N1+1])
-            
-            z1 = (HR * Y.T).T # Temporal convolution
-            z1 = jnp.fft.ifft(z1, axis=0)[:int(N+2*dN), :]
-            #if (rdx+(sgn==1)*K1==0): debug = HR
-
-            for sdx in range(K2): # Note zero indexing
-                HS = gen_corf_j(sv[sdx], M1, SRF, [sdx+BP+1, K2+BP*2]) 
-                z1 = z1*HS # Frequency convolution
-                
-                R1v = jnp.fft.ifft(z1, M2) # Second inverse FFT
-                if dM == 0:
-                    #cr[sdx, rdx+(sgn==1)*K1, :, :] = R1v[:, dM:dM+M]
-                    cr = cr.at[sdx, rdx+(sgn==1)*K1, :, :].set(R1v[:, dM:dM+M])
-                else: 
-                    raise NotImplementedError
+    z1 = HR[:, :, None] * Y[None, :, :] # Temporal convolution, 2K1 x N2 x M1
+    z1 = jnp.fft.ifft(z1, axis=1)[:, :int(N+2*dN), :]
+
+    z1 = z1[None, :, :, :] * HS[:, None, None, :] # Frequency convolution, K2 x 2K1 x N x M1
+    R1v = jnp.fft.ifft(z1, M2, axis=3) # Second inverse FFT
+    cr = R1v[:, :, :, dM:dM+M]
     return cr
 
 @partial(jit, static_argnums=1)
@@ -390,7 +643,7 @@ def gen_cort_j(fc, L, STF, PASS):
     '''
 
     # Tonotopic axis
-    t = jnp.linspace(0, L-1, L) / STF * fc
+    t = jnp.arange(L) * (fc / STF)
     h = jnp.sin(2*np.pi*t) * t**2 * jnp.exp(-3.5*t) * fc
     h = h - jnp.mean(h)
     
@@ -416,7 +669,7 @@ def gen_corf_j(fc, L, SRF, KIND):
     #     KIND = 2
 
     # tonotopic axis
-    R1 = jnp.array([i for i in range(L)]) / L * SRF / 2 / jnp.abs(fc)
+    R1 = jnp.arange(L) * (SRF / (2*L*jnp.abs(fc)))
     if KIND == 1:
         C1 = 1/2/0.3/0.3
         H = jnp.exp(-C1*(R1-1)**2) + jnp.exp(-C1*(R1+1)**2)
@@ -454,22 +707,19 @@ def strf(y, sr):
   N1, M1 = 2**ceil(np.log2(N)), 2**ceil(np.log2(M))
   N2, M2 = N1*2, M1*2
   
-  Y = jnp.fft.fft(y, M2, axis=1)[:,:M1] # Fourier transform (frequency)
+  Y = jnp.fft.rfft(y, M2, axis=1)[:,:M1] # Fourier transform (frequency)
   Y = jnp.fft.fft(Y[:N,:], N2, axis=0) # Fourier transform (temporal)
 
-  cr = []
-  for i in range(len(sr)): # rate filtering
-    (s,r) = sr[i,:]
-    
-    HR = gen_cort_strf(r, N1, STF) 
-    z1 = (HR * Y.T).T # Temporal convolution
-    z1 = jnp.fft.ifft(z1, axis=0)[:N, :]
-
-    HS = gen_corf_strf(s, M1, SRF) 
-    z1 = z1*HS # Frequency convolution
-    R1v = jnp.fft.ifft(z1, M2) # Second inverse FFT
-    cr.append(jnp.expand_dims(R1v[:, :M], axis=0))
-  cr = jnp.vstack(cr)
+  # All STRFs at once: n_strfs x N2 rate filters and n_strfs x M1 scale filters
+  HR = vmap(lambda r: gen_cort_strf(r, N1, STF))(sr[:, 1])
+  HS = vmap(lambda s: gen_corf_strf(s, M1, SRF))(sr[:, 0])
+
+  z1 = HR[:, :, None] * Y[None, :, :] # Temporal convolution
+  z1 = jnp.fft.ifft(z1, axis=1)[:, :N, :]
+
+  z1 = z1*HS[:, None, :] # Frequency convolution
+  R1v = jnp.fft.ifft(z1, M2, axis=2) # Second inverse FFT
+  cr = R1v[:, :, :M]
   return cr
 
 @partial(jit, static_argnums=1)
@@ -487,14 +737,14 @@ def gen_cort_strf(r, L, STF):
     '''
     #eps = 1e-15
     # Tonotopic axis
-    t = jnp.linspace(0, L-1, L) / STF * jnp.abs(r) # Generating an array of frequencies
+    t = jnp.arange(L) * (jnp.abs(r) / STF) # Generating an array of frequencies
     t = jnp.sin(2*np.pi*t) * t**2 * jnp.exp(-3.5*t) * jnp.abs(r)
     
     t = jnp.fft.fft(t-jnp.mean(t), 2*L)
     #signs = jnp.concatenate([jnp.ones(1), jnp.ones(L-1) * jnp.sign(r), -jnp.ones(1), jnp.ones(L-1) * (-jnp.sign(r))])
     signs = jnp.concatenate([jnp.ones(L) * jnp.sign(r), jnp.ones(L) * (-jnp.sign(r))])
     signs = (signs+1)/2
-    t = t.at[:].multiply(signs)
+    t = t * signs
     #t = jnp.where(jnp.abs(t)<eps, eps, t)
     H = t / jnp.max(jnp.abs(t))
     return H
@@ -503,7 +753,7 @@ def gen_cort_strf(r, L, STF):
 def gen_corf_strf(fc, L, SRF):
 
     # tonotopic axis
-    R1 = jnp.array([i for i in range(L)]) / L * SRF / 2 / jnp.abs(fc)
+    R1 = jnp.arange(L) * (SRF / (2*L*jnp.abs(fc)))
     R1 = R1**2
     H = R1 * jnp.exp(1-R1)
     return H
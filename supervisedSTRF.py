@@ -31,8 +31,7 @@ class supervisedSTRF(nn.Module):
       if self.use_class:
         self.audspec = AuditorySpectrogram(input_length=16000)
       else:
-        with np.load('cochlear_filter_params.npz') as data:
-          self.Bs, self.As = jnp.array(data['Bs']), jnp.array(data['As'])
+        self.Bs, self.As = read_cochba_j()
         self.LIN = nn.Conv(features=1, kernel_size=(2,), strides=(1,))
 
 
@@ -56,14 +55,8 @@ class supervisedSTRF(nn.Module):
       x = nn.relu(x)
 
       # leaky integration here
-      out = []
-      #print(x.shape)
-      for i in range(len(x)):
-          out.append(leaky_integrator_fft(x[i,:], alpha)) # This can be vectorized
-      x = jnp.vstack(out)
-      x = x.real
       L_frm = 80
-      x = x[:, (L_frm - 1)::L_frm].T
+      x = leaky_integrator(x, alpha, L_frm).T
     
     return x
   